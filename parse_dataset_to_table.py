@@ -1,6 +1,9 @@
 """
 This script will parse the pubmed dataset and filter the articles that belong to the psychology journals.
-The script will save the filtered articles in batches of 500k rows to avoid memory issues.
+The dataset is split into shards that are processed in parallel, each shard is read and filtered as arrow tables of
+many rows, instead of iterating the rows as python dicts one by one.
+The filtered articles of each shard are streamed to a separate csv (or parquet) file in small batches, so memory use
+doesn't grow with the output.
 To modify the journals list, you can change the 'psy_journals_list.csv' file.
 
 The information about the pubmed tags, which serve as columns in the final data  can be found here:
@@ -13,31 +16,204 @@ https://huggingface.co/docs/datasets/index
 import os
 from argparse import ArgumentParser
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from time import time
 
 import datasets
-import pandas as pd
-from tqdm import tqdm
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
 from pubmed import ensure_dir
 
+# The flattened dataset columns that are saved in the final table, mapped to the names of the columns in the table
+OUTPUT_COLUMNS = {
+    'MedlineCitation.PMID': 'PMID',
+    'MedlineCitation.Article.ArticleTitle': 'ArticleTitle',
+    'MedlineCitation.Article.Language': 'ArticleLanguage',
+    'MedlineCitation.Article.Abstract.AbstractText': 'AbstractText',
+    'MedlineCitation.Article.Journal.Title': 'JournalTitle',
+    'MedlineCitation.Article.Journal.ISSN': 'JournalISSN',
+    'MedlineCitation.Article.Journal.ISOAbbreviation': 'ISOAbbreviation',
+    'MedlineCitation.Article.Journal.JournalIssue.PubDate.Year': 'PubDate',
+    'MedlineCitation.Article.Journal.JournalIssue.PubDate.MedlineDate': 'MedlineDate',
+    'MedlineCitation.MedlineJournalInfo.MedlineTA': 'MedlineTA',
+}
+# The flattened dataset column of the abstracts, articles without an abstract are dropped
+ABSTRACT_COLUMN = 'MedlineCitation.Article.Abstract.AbstractText'
+# The flattened dataset columns of the journal keys, mapped to the names of their lowercased copies
+LOWERCASE_COLUMNS = {
+    'MedlineCitation.Article.Journal.ISSN': 'issn_low',
+    'MedlineCitation.Article.Journal.Title': 'title_low',
+    'MedlineCitation.Article.Journal.ISOAbbreviation': 'abbr_iso_low',
+    'MedlineCitation.MedlineJournalInfo.MedlineTA': 'abbr_med_low',
+}
+# The columns that are used to match the journals, in the order expected by is_psy_journal
+FILTER_COLUMNS = ['MedlineCitation.PMID', *LOWERCASE_COLUMNS.values()]
+# Number of rows read and filtered at once, smaller batch -> less memory.
+BATCH_SIZE = 10000
+# Minimal number of filtered rows written to the output file at once (a parquet row group), smaller batch -> less
+# memory, but slower to encode and a larger (parquet) file.
+WRITE_BATCH_SIZE = 50000
+# Size of the buffer of the output file, the encoded batches are written to the disk in a few large writes.
+WRITE_BUFFER_SIZE = 32 * 1024 * 1024
+# Number of rows of a shard read between two progress reports of the shard, a report per batch would flood the output.
+PROGRESS_SIZE = 500000
 
-# extract and merge the unique values from the journals_df into a dictionary with combined keys
-def extract_unique_journals(journals_df):
+
+# extract and merge the unique values from the journals table into frozensets of (issns, titles, abbreviations, ids)
+def extract_unique_journals(journals_table):
     # drop the boolean column that doesn't contain any keys
-    jdf = journals_df.drop(columns=['Matched_ISSN'])
+    jt = journals_table.drop_columns(['Matched_ISSN'])
     _dict = defaultdict(set)
-    # iterate over the columns and update the dictionary with the unique values
-    for col in jdf.columns:
+    # iterate over the columns and update the dictionary with the unique values, in a single pass over the non-missing
+    # values of each column
+    for col in jt.column_names:
+        values = jt[col].drop_null().to_pylist()
         if 'issn' in col.lower():
-            _dict['issn'].update(jdf[col].str.split(',').explode().str.strip().str.lower())
+            _dict['issn'].update(issn.strip().lower() for value in values for issn in value.split(','))
         elif 'title' in col.lower():
-            _dict['title'].update(jdf[col].str.strip().str.lower())
+            _dict['title'].update(value.strip().lower() for value in values)
         elif 'abbr' in col.lower():
-            _dict['abbr'].update(jdf[col].str.strip().str.lower())
+            _dict['abbr'].update(value.strip().lower() for value in values)
         elif 'id' in col.lower():
-            _dict['id'].update(jdf[col])
-    return _dict
+            # stored as python ints, compared to the integer PMIDs. The ids that aren't integers (e.g. NLM ids such as
+            # 0375362R) can't match any PMID and are skipped
+            _dict['id'].update(int(_id) for _id in values if str(_id).strip().isdecimal())
+    # frozen once, as they are only used for membership checks
+    return tuple(frozenset(_dict[key]) for key in ('issn', 'title', 'abbr', 'id'))
+
+
+# batched map function, lowercases the journal keys of an arrow batch into new columns
+def lowercase_keys(batch):
+    lowercase = {name: pc.utf8_lower(batch.column(column)) for column, name in LOWERCASE_COLUMNS.items()}
+    # The MedlineTA is nearly always the same as the ISO abbreviation, it's kept only where it's different (null
+    # otherwise), so the same abbreviation isn't checked twice
+    abbr_iso, abbr_med = lowercase['abbr_iso_low'], lowercase['abbr_med_low']
+    lowercase['abbr_med_low'] = pc.if_else(pc.equal(abbr_iso, abbr_med), pa.scalar(None, pa.string()), abbr_med)
+    return pa.table(lowercase)
+
+
+# add the lowercased journal keys to the dataset, the lowercased columns are computed once and cached on disk
+# by the datasets library, so the following runs (e.g. with a different journals list) only read them
+def add_lowercase_keys(dataset, num_proc=None):
+    keys = dataset.select_columns(list(LOWERCASE_COLUMNS)).with_format('arrow')
+    lowercase = keys.map(lowercase_keys, batched=True, batch_size=BATCH_SIZE, num_proc=num_proc,
+                         remove_columns=list(LOWERCASE_COLUMNS), desc='Lowercasing journal keys')
+    return datasets.concatenate_datasets([dataset, lowercase.with_format(None)], axis=1)
+
+
+# build the arrow lookup options of the (issns, titles, abbreviations, ids) once, instead of converting the python sets
+# on every batch. A kind of key that has no values in the journals list (e.g. no abbreviations column) is None.
+def journal_lookups(journals, id_type=pa.int64()):
+    issn_set, title_set, abbr_set, ids = journals
+    value_sets = [pa.array(sorted(keys), type=pa.string()) for keys in (issn_set, title_set, abbr_set)]
+    # The ids are looked up with the type of the PMID column, so the PMIDs aren't cast in every batch. The ids out of
+    # the range of that type can't match any PMID.
+    ids = pa.array(sorted(ids), type=pa.int64())
+    if id_type != ids.type:
+        id_info = np.iinfo(id_type.to_pandas_dtype())
+        ids = ids.filter(pc.and_(pc.greater_equal(ids, id_info.min), pc.less_equal(ids, id_info.max))).cast(id_type)
+    value_sets.append(ids)
+    return tuple(pc.SetLookupOptions(value_set) if len(value_set) else None for value_set in value_sets)
+
+
+# vectorized filter function, receives the FILTER_COLUMNS as arrow arrays and returns a boolean array (True -> keep)
+def is_psy_journal(pmids, issns, titles, abbrs_iso, abbrs_med, lookups):
+    issn_lookup, title_lookup, abbr_lookup, id_lookup = lookups
+    # The membership checks run as arrow compute kernels (is_in) over the lowercased columns, there is no python
+    # loop over the rows.
+    # All the journal keys are encoded together as a dictionary, journal strings repeat a lot within a batch (articles
+    # of the same journal), so only the unique strings are looked up, and the results are then mapped back to the
+    # rows. Each kind of key is still only checked against the keys of the same kind.
+    n = len(pmids)
+    keys = pc.dictionary_encode(pa.chunked_array(issns.chunks + titles.chunks + abbrs_iso.chunks + abbrs_med.chunks,
+                                                 type=pa.string())).combine_chunks()
+
+    def lookup(options, offset, length):
+        return pc.take(pc.is_in(keys.dictionary, options=options), keys.indices.slice(offset, length))
+
+    # A kind of key without a lookup (no values in the journals list) isn't checked at all
+    mask = pa.repeat(False, n)
+    if issn_lookup is not None:
+        mask = pc.or_(mask, lookup(issn_lookup, 0, n))
+    if abbr_lookup is not None:
+        # both abbreviations are mapped back at once, the MedlineTA is null where it's the same as the ISO abbreviation
+        abbr_mask = pc.fill_null(lookup(abbr_lookup, 2 * n, 2 * n), False)
+        mask = pc.or_(mask, pc.or_(abbr_mask.slice(0, n), abbr_mask.slice(n)))
+    if title_lookup is not None:
+        mask = pc.or_(mask, lookup(title_lookup, n, n))
+    if id_lookup is not None:
+        mask = pc.or_(mask, pc.is_in(pmids, options=id_lookup))
+    return mask
+
+
+# open a writer of the output file (path or stream) in the given format, both writers receive arrow tables through
+# write_table
+def open_writer(sink, schema, file_format='csv'):
+    if file_format == 'parquet':
+        # compressed columnar file, the (long) abstracts aren't quoted or escaped
+        return pq.ParquetWriter(sink, schema, compression='zstd', compression_level=3)
+    return pa_csv.CSVWriter(sink, schema)
+
+
+# filter a single shard of the dataset and stream its psychology articles to a separate output file, returns the number
+# of saved articles and the number of articles without an abstract
+def process_shard(dataset, shard_idx, num_shards, journals, output, file_format='csv'):
+    shard = dataset.shard(num_shards=num_shards, index=shard_idx, contiguous=True)
+    schema = pa.schema([dataset.data.schema.field(column).with_name(name) for column, name in OUTPUT_COLUMNS.items()])
+    # the lookup options can't be pickled, so they are built in the process of the shard
+    lookups = journal_lookups(journals, dataset.data.schema.field('MedlineCitation.PMID').type)
+    count, missing_abstracts, processed = 0, 0, 0
+    # The writer is closed before the (buffered) output stream, so all the data is flushed to the file, and the writes
+    # thread is joined before the writer is closed
+    with pa.output_stream(output, buffer_size=WRITE_BUFFER_SIZE) as sink, \
+            open_writer(sink, schema, file_format) as writer, ThreadPoolExecutor(max_workers=1) as executor:
+        # The filtered batches are small, they are collected and encoded together, as a few large tables
+        pending, pending_rows = [], 0
+        # The tables are encoded and written in a background thread (pyarrow releases the GIL), while the next
+        # batches are filtered. At most one write is in flight, so the pending tables don't pile up in memory.
+        write = None
+        # Iterate the shard as arrow tables, the filter columns are passed to the filter function as arrow arrays,
+        # and only the matching rows of the output columns are written. No row is converted to a python dict.
+        for batch in shard.with_format('arrow').iter(batch_size=BATCH_SIZE):
+            if processed // PROGRESS_SIZE != (processed + batch.num_rows) // PROGRESS_SIZE:
+                # a single write with the newline, so the lines of the concurrent shards aren't interleaved
+                print(f'Processed: {processed + batch.num_rows} of {len(shard)} rows (shard {shard_idx})\n', end='',
+                      flush=True)
+            processed += batch.num_rows
+            batch = batch.select(list(dict.fromkeys([*OUTPUT_COLUMNS, *FILTER_COLUMNS])))
+            # Cheap pre-rejection in arrow, the articles without an abstract are dropped before any of the journal
+            # keys are checked
+            num_rows = batch.num_rows
+            batch = batch.filter(pc.greater(pc.utf8_length(batch.column(ABSTRACT_COLUMN)), 0))
+            missing_abstracts += num_rows - batch.num_rows
+            mask = is_psy_journal(*(batch.column(column) for column in FILTER_COLUMNS), lookups)
+            psy_articles = batch.filter(mask).select(list(OUTPUT_COLUMNS))
+            if psy_articles.num_rows:
+                pending.append(psy_articles)
+                pending_rows += psy_articles.num_rows
+            if pending_rows >= WRITE_BATCH_SIZE:
+                if write is not None:
+                    write.result()
+                write = executor.submit(writer.write_table, pa.concat_tables(pending).rename_columns(schema.names))
+                count += pending_rows
+                pending, pending_rows = [], 0
+        if write is not None:
+            write.result()
+        if pending:
+            writer.write_table(pa.concat_tables(pending).rename_columns(schema.names))
+            count += pending_rows
+    return count, missing_abstracts
+
+
+# unpack the arguments of a shard for Pool.imap_unordered, the shard index is returned with its counts, as the shards
+# complete in any order
+def process_shard_args(shard_args):
+    return shard_args[1], process_shard(*shard_args)
 
 
 if __name__ == '__main__':
@@ -50,111 +226,50 @@ if __name__ == '__main__':
                         help='Path to the journals list CSV file')
     parser.add_argument('--dataset', type=str, default='data/pubmed',
                         help='Path to the pubmed dataset in huggingface-datasets format')
-    parser.add_argument('--output', type=str, default='psy_articles', help='Path to the output CSV file')
+    parser.add_argument('--output', type=str, default='psy_articles',
+                        help='Path to the output file, a separate file is saved for each process')
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet'],
+                        help='Format of the output file')
+    parser.add_argument('--num_proc', type=int, default=os.cpu_count(),
+                        help='Number of processes (and output files) used to filter the dataset')
     args = parser.parse_args()
 
     data = args.dataset
     journals_list = args.journals_list
     output = args.output
     output = output.split('.')[0]
+    num_shards = args.num_proc
 
     cache_dir = ensure_dir(os.path.join(data.rsplit('/', 1)[0], "cache"))
-    # Load the dataset
+    # Load the dataset, flattened so that each (nested) field is a separate column and can be read on its own
     dataset = datasets.load_dataset(data, cache_dir=cache_dir)
+    train = dataset["train"].flatten()
+    # Lowercase the journal keys, only on the first run, the following runs load the lowercased keys from the cache
+    train = add_lowercase_keys(train, args.num_proc)
+
+    # Load the journals list as an arrow table, the empty cells are read as missing values
+    journals_table = pa_csv.read_csv(journals_list, convert_options=pa_csv.ConvertOptions(strings_can_be_null=True))
+
+    # Extract unique values from the journals table
+    journals = extract_unique_journals(journals_table)
+
+    # Filter the articles that belong to the psychology journals, each process filters and saves a contiguous shard
+    outputs = [f'{output}_{shard_idx}.{args.format}' for shard_idx in range(num_shards)]
+    # Each shard reports its progress every PROGRESS_SIZE rows, and once more as soon as its file is saved (in the
+    # order the shards complete)
+    counts, missing = [0] * num_shards, [0] * num_shards
+    shard_args = [(train, shard_idx, num_shards, journals, outputs[shard_idx], args.format)
+                  for shard_idx in range(num_shards)]
+    with Pool(num_shards) as pool:
+        for shard_idx, (shard_count, shard_missing) in pool.imap_unordered(process_shard_args, shard_args):
+            counts[shard_idx], missing[shard_idx] = shard_count, shard_missing
+            print(f'Saved {shard_count} articles to {outputs[shard_idx]}', flush=True)
 
-    # Load the journals list
-    journals_df = pd.read_csv(journals_list, header=0, sep=',')
-
-    # Extract unique values from the journals_df
-    match_dict = extract_unique_journals(journals_df)
-
-    # Create a list (table) to store the filtered articles, and initialize the counters
-    table = []
-    count = 0
-    missing_abstracts = 0
-    filtered_articles = 0
-    _batch = 0
-
-    # Iterate over the dataset rows and filter the articles that belong to the psychology journals
-    for row in tqdm(dataset["train"]):
-        medline = row['MedlineCitation']
-        pmid = medline['PMID']
-        # date_completed = medline['DateCompleted']['Year']
-        # date_revised = medline['DateRevised']['Year']
-
-        article = medline['Article']
-        journal = article['Journal']
-        journal_issue = journal['JournalIssue']
-
-        article_abstract = article['Abstract']['AbstractText']
-        article_title = article['ArticleTitle']
-        article_language = article['Language']
-
-        journal_title = journal['Title']
-        journal_issn = journal['ISSN']
-        journal_abbr_iso = journal['ISOAbbreviation']
-
-        journal_year = journal_issue['PubDate']['Year']
-        journal_med_year = journal_issue['PubDate']['MedlineDate']
-
-        journal_abbr_med = medline['MedlineJournalInfo']['MedlineTA']
-
-        # Check if the article has an abstract
-        if article_abstract:
-            # Check if the article belongs to the psychology journals
-            if pmid in match_dict['id'] or \
-                    journal_issn.lower() in match_dict['issn'] or \
-                    journal_title.lower() in match_dict['title'] or \
-                    journal_abbr_iso.lower() in match_dict['abbr'] or journal_abbr_med.lower() in match_dict['abbr']:
-                # Increment the count of the articles
-                count += 1
-                # If the article belongs to the psychology journals, then append it to the table, as a dictionary.
-                # Each dict key will be a column in the DataFrame that will be created later.
-                table.append(
-                    dict(
-                        PMID=pmid,
-                        # DateCompleted=date_completed,
-                        # DateRevised=date_revised,
-                        ArticleTitle=article_title,
-                        ArticleLanguage=article_language,
-                        AbstractText=article_abstract,
-                        JournalTitle=journal_title,
-                        JournalISSN=journal_issn,
-                        ISOAbbreviation=journal_abbr_iso,
-                        PubDate=journal_year,
-                        MedlineDate=journal_med_year,
-                        MedlineTA=journal_abbr_med
-                    ))
-            else:
-                # If the article doesn't belong to the psychology journals, then increment the filtered articles count
-                filtered_articles += 1
-        else:
-            # If the article doesn't have an abstract, then increment the missing abstracts count
-            missing_abstracts += 1
-        # Will save the data in batches of up to 500k rows, to reduce memory consumption. Smaller batch -> less memory.
-        if count > 0 and count % 500000 == 0:
-            print('Processed:', count)
-            # Create a DataFrame from the table
-            _df = pd.DataFrame.from_records(table)
-            print(f'df info: {_df.info()}')
-            print('Saving batch...')
-            # Save the DataFrame to a csv file, with the defined separator
-            _df.to_csv(f'{output}_{_batch}.csv', sep=',', index=False)
-            print(f'Saved batch {_batch}')
-            print('will dump the table to free memory')
-            _batch += 1
-            # Clear the table to free memory
-            table = []
-    else:
-        # Save the remaining rows
-        print('Processed:', count)
-        # Create a DataFrame from the table
-        _df = pd.DataFrame.from_records(table)
-        print(f'df info: {_df.info()}')
-        print('Saving the remaining batch...')
-        # Save the DataFrame to a csv file, with the defined separator
-        _df.to_csv(f'{output}_{_batch}.csv', index=False)
-        print(f'Saved batch {_batch}')
+    # Count the articles without an abstract (already counted by the shards, the abstracts aren't read again), and those
+    # that had an abstract but were dropped
+    count = sum(counts)
+    missing_abstracts = sum(missing)
+    filtered_articles = len(train) - missing_abstracts - count
 
     print('Total number of articles after filtering:', count)
     print('Missing abstracts:', missing_abstracts)
@@ -26,14 +26,28 @@ For more details, refer to: https://ftp.ncbi.nlm.nih.gov/pubmed/
 The script uses the 'datasets' library to download and parse the XML files.
 """
 
-import copy
-import gzip
+import glob
+import hashlib
+import inspect
 import logging
+import mmap
 import os
+import time
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 import datasets
+import pyarrow as pa
+from datasets.utils.file_utils import cached_path
+from filelock import FileLock, Timeout
+
+try:
+    # ISA-L inflate (python-isal) is several times faster than zlib, the stdlib zlib is used when it isn't installed
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 logger = logging.getLogger(__name__)
 
@@ -53,8 +67,35 @@ _URLs = [f"https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/pubmed24n{i:04d}.xml.gz"
 # Comment out the above line and uncomment the below line to download only 3 random files for testing purposes
 # _URLs = [f"https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/pubmed24n{i:04d}.xml.gz" for i in [9, 16, 100]]
 
+# Size of the blocks of the compressed files that are decompressed at once
+COMPRESSED_BLOCK_SIZE = 64 * 1024
+# Seconds between the attempts to start a download, while the maximal number of files are already being downloaded
+DOWNLOAD_WAIT = 1
+# Number of articles in each arrow table that is written to the dataset
+TABLE_SIZE = 10000
+# The elements that are kept as their inner XML (they contain html tags)
+INNER_XML_TAGS = {"AbstractText", "ArticleTitle"}
+# The tags that delimit the articles in the XML files
+ARTICLE_START = b"<PubmedArticle>"
+ARTICLE_END = b"</PubmedArticle>"
+
 MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10,
           'Nov': 11, 'Dec': 12}
+# The month names and the common numbers (days, months and years) mapped to their int values, in a single lookup.
+# Any other string is converted with int().
+MONTHS_AND_NUMBERS = {**{str(i): i for i in range(2101)}, **{f"{i:02d}": i for i in range(100)}, **MONTHS}
+
+
+def deep_copy(value):
+    """Copy the nested lists and dicts of the parsed XML, the other values (str, int) are immutable and are shared"""
+    value_type = type(value)
+    if value_type is dict:
+        return {k: deep_copy(v) for k, v in value.items()}
+    if value_type is list:
+        return [deep_copy(v) for v in value]
+    if value_type is set:
+        return set(value)
+    return value
 
 
 # Copyright Ferry Boender, released under the MIT license.
@@ -72,50 +113,232 @@ def deepupdate(target, src):
     >>> print(t)
     {'name': 'Ferry', 'hobbies': ['programming', 'sci-fi', 'gaming']}
     """
+    # The values are dispatched on their exact type, and the target value is looked up once per key.
+    # The same rules as above: a scalar key that isn't in the target raises a KeyError (the article is dropped), and a
+    # value of a different type than the target is ignored (after trying to convert strings to the int fields).
     for k, v in src.items():
-        if k in target and isinstance(target[k], int) and isinstance(v, str):
-            try:
-                v = MONTHS.get(v) if v in MONTHS else int(v)
-            except Exception as e:
-                logger.warning(e)
-                logger.debug(f"Failed to convert {v} to int for v={v} ; k={k} ; target={target}; src={src}")
-                pass
-        if k in target and type(target[k]) != type(v):
-            logger.warning(f"Ignoring field {k} it's a {type(v)} and we expect a {type(target[k])}")
-            continue
-
-        if type(v) == list:
-            if k not in target:
-                target[k] = copy.deepcopy(v)
-            elif isinstance(target[k], list):
-                target[k].extend(v)
-            elif isinstance(target[k], str):
-                # Very special case to handle `AbstractText` which sometimes end up
-                # being a list.
-                new_v = " ".join(el for el in v if isinstance(el, str))
-                target[k] = new_v
-            else:
-                logger.warning(f"Ignoring field {k} it's a {type(v)} and we expect a {type(target[k])}")
-        elif type(v) == dict:
-            if k not in target:
-                target[k] = copy.deepcopy(v)
-            elif isinstance(target[k], dict):
-                deepupdate(target[k], v)
-            else:
-                logger.warning(f"Ignoring field {k} it's a {type(v)} and we expect a {type(target[k])}")
-        elif type(v) == set:
-            if k not in target:
-                target[k] = v.copy()
-            elif isinstance(target[k], set):
-                target[k].update(v.copy())
+        v_type = type(v)
+        if k in target:
+            target_v = target[k]
+            if type(target_v) is not v_type:
+                if isinstance(target_v, int) and v_type is str:
+                    number = MONTHS_AND_NUMBERS.get(v)
+                    if number is not None:
+                        v, v_type = number, int
+                    else:
+                        try:
+                            v = int(v)
+                            v_type = int
+                        except Exception as e:
+                            logger.warning(e)
+                            logger.debug(f"Failed to convert {v} to int for v={v} ; k={k} ; target={target}; src={src}")
+                if type(target_v) is not v_type:
+                    logger.warning(f"Ignoring field {k} it's a {v_type} and we expect a {type(target_v)}")
+                    continue
+
+            if v_type is list:
+                target_v.extend(v)
+            elif v_type is dict:
+                deepupdate(target_v, v)
+            elif v_type is set:
+                target_v.update(v)
+            elif v_type is tuple:
+                logger.warning(f"Ignoring field {k} it's a {v_type} and we expect a {type(target_v)}")
             else:
-                logger.warning(f"Ignoring field {k} it's a {type(v)} and we expect a {type(target[k])}")
+                # str and int values are immutable, no need to copy them
+                target[k] = v
+        elif v_type is list or v_type is dict:
+            target[k] = deep_copy(v)
+        elif v_type is set:
+            target[k] = set(v)
         else:
-            if isinstance(target[k], (list, tuple, dict)):
-                logger.warning(f"Ignoring field {k} it's a {type(v)} and we expect a {type(target[k])}")
+            raise KeyError(k)
+
+
+def compile_encoder(features):
+    """
+    Generate an encoder function for the given features, the generated function encodes an example exactly as
+    features.encode_example does (raising the same errors for invalid examples).
+    The generic encoding walks the features tree and checks the type of every feature for every example, the generated
+    code has a function per dict or Sequence of the features, and the conversions of the Value fields are inlined.
+    Only dict, Sequence and Value features are supported (the ones used by the dataset).
+    """
+    functions = []
+
+    def conversion(value):
+        # The same conversions as Value.encode_example
+        if pa.types.is_boolean(value.pa_type):
+            return "bool"
+        if pa.types.is_integer(value.pa_type):
+            return "int"
+        if pa.types.is_floating(value.pa_type):
+            return "float"
+        if pa.types.is_string(value.pa_type):
+            return "str"
+        return ""
+
+    def add_function(schema, level):
+        name = f"_encode_{len(functions)}"
+        functions.append(None)
+        index = len(functions) - 1
+        if isinstance(schema, dict):
+            lines = [f"def {name}(obj):", "    if obj is None:",
+                     "        raise ValueError('Got None but expected a dictionary instead')" if level == 0
+                     else "        return None"]
+            items = []
+            for i, (key, feature) in enumerate(schema.items()):
+                if isinstance(feature, datasets.Value):
+                    lines.append(f"    v = obj.get({key!r})")
+                    lines.append(f"    e{i} = None if v is None else {conversion(feature)}(v)")
+                else:
+                    lines.append(f"    e{i} = {add_function(feature, level + 1)}(obj.get({key!r}))")
+                items.append(f"{key!r}: e{i}")
+            lines.append(f"    return {{{', '.join(items)}}}")
+        elif isinstance(schema, datasets.Sequence) and isinstance(schema.feature, dict):
+            # A list of dicts is encoded as a dict of lists
+            encoders = {key: add_function(feature, level + 1) for key, feature in schema.feature.items()}
+            lists = [f"{key!r}: [{encoder}(o.get({key!r})) for o in obj]" for key, encoder in encoders.items()]
+            single = [f"{key!r}: [{encoder}(o) for o in obj[{key!r}]] if {key!r} in obj else None"
+                      for key, encoder in encoders.items()]
+            lines = [f"def {name}(obj):", "    if obj is None:", "        return None",
+                     "    if isinstance(obj, (list, tuple)):", f"        return {{{', '.join(lists)}}}",
+                     f"    return {{{', '.join(single)}}}"]
+        elif isinstance(schema, datasets.Sequence) and isinstance(schema.feature, datasets.Value):
+            lines = [f"def {name}(obj):", "    if obj is None:", "        return None",
+                     "    if isinstance(obj, str):",
+                     "        raise ValueError(f\"Got a string but expected a list instead: '{obj}'\")",
+                     "    if len(obj) == 0:", "        return []",
+                     f"    return [None if o is None else {conversion(schema.feature)}(o) for o in obj]"]
+        elif isinstance(schema, datasets.Value):
+            lines = [f"def {name}(obj):", f"    return None if obj is None else {conversion(schema)}(obj)"]
+        else:
+            raise NotImplementedError(f"Can't compile an encoder for the feature {schema}")
+        functions[index] = "\n".join(lines)
+        return name
+
+    encoder = add_function(features, 0)
+    namespace = {}
+    exec(compile("\n\n".join(functions), "<features encoder>", "exec"), namespace)
+    return namespace[encoder]
+
+
+def inner_xml(element):
+    """
+    The inner XML of the element, as a string
+    Very special case, for AbstractText and ArticleTitle that contain html tags (leading to having very odd structure)
+    """
+    tail = element.tail
+    if element.attrib or len(element) == 0 or (tail and not tail.isspace()) or \
+            any(child.attrib or "{" in child.tag for child in element.iter() if child is not element):
+        # The elements with attributes or namespaces (e.g. MathML), are kept exactly as they were serialized
+        tag = element.tag
+        string = ET.tostring(element).decode("utf-8").strip()
+        return string[len(f"<{tag}>"): -len(f"</{tag}>")]
+
+    # The plain html tags are serialized directly, the same as ET.tostring (as us-ascii), without the round trip
+    parts = [escape_xml_text(element.text)] if element.text else []
+    serialize_children(element, parts)
+    string = "".join(parts)
+    return string if string.isascii() else string.encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+
+def escape_xml_text(text):
+    """Escapes the text of an element, as ET.tostring"""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def serialize_children(element, parts):
+    """Appends the XML of the children of the element (without attributes) to parts, as ET.tostring"""
+    for child in element:
+        tag = child.tag
+        if child.text or len(child):
+            parts.append(f"<{tag}>")
+            if child.text:
+                parts.append(escape_xml_text(child.text))
+            serialize_children(child, parts)
+            parts.append(f"</{tag}>")
+        else:
+            parts.append(f"<{tag} />")
+        if child.tail:
+            parts.append(escape_xml_text(child.tail))
+
+
+def decompress_gzip(filename):
+    """
+    Yields the decompressed data of a gzip file, in blocks.
+    The compressed file is memory mapped and its blocks are fed directly to the decompressor, without the buffers of a
+    gzip file object. Like gzip.open, files of several gzip members (and zero padding between them) are supported, and
+    a truncated file raises an EOFError.
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as compressed:
+        offset = 0
+        while offset < len(compressed):
+            if compressed[offset] == 0:
+                offset += 1
+                continue
+            # 32 + 15: a gzip header and the maximal window size
+            decompressor = zlib.decompressobj(32 + 15)
+            for start in range(offset, len(compressed), COMPRESSED_BLOCK_SIZE):
+                end = min(start + COMPRESSED_BLOCK_SIZE, len(compressed))
+                yield decompressor.decompress(compressed[start:end])
+                if decompressor.eof:
+                    break
+            yield decompressor.flush()
+            if not decompressor.eof:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            offset = end - len(decompressor.unused_data)
+
+
+def download_file(url, download_config):
+    """
+    Downloads a file into the cache (or finds it there) and returns its path.
+    The processes that parse the files download them too, but at most download_config.num_proc files are downloaded at
+    once by all the processes together (as with dl_manager.download), each download holds one of as many lock files.
+    """
+    lock_dir = ensure_dir(os.path.join(download_config.cache_dir or datasets.config.DOWNLOADED_DATASETS_PATH, "locks"))
+    max_downloads = download_config.num_proc or 1
+    locks = [FileLock(os.path.join(lock_dir, f"pubmed_download_{i}.lock")) for i in range(max_downloads)]
+    while True:
+        for lock in locks:
+            try:
+                lock.acquire(timeout=0)
+            except Timeout:
                 continue
+            try:
+                return cached_path(url, download_config=download_config)
+            finally:
+                lock.release()
+        time.sleep(DOWNLOAD_WAIT)
 
-            target[k] = copy.copy(v)
+
+def split_articles(blocks):
+    """
+    Split the XML data (the decompressed blocks of a file) into the PubmedArticle elements and yield the XML (bytes) of
+    each article.
+    Each article is then parsed on its own, the C parser builds its tree without a python call per element (as the
+    events of iterparse), and the memory doesn't grow with the size of the file.
+    The articles are found by their tags, they have no attributes and the tags can't appear in the text (escaped).
+    """
+    buffer = b""
+    for block in blocks:
+        buffer += block
+        pos = 0
+        while (end := buffer.find(ARTICLE_END, pos)) >= 0:
+            start = buffer.find(ARTICLE_START, pos, end)
+            pos = end + len(ARTICLE_END)
+            if start >= 0:
+                yield buffer[start:pos]
+        buffer = buffer[pos:]
+    if ARTICLE_START in buffer:
+        logger.warning("Ignoring the last article of the file, it is truncated")
 
 
 def default_date():
@@ -170,7 +393,7 @@ def default_article():
     }
 
 
-class Pubmed(datasets.GeneratorBasedBuilder):
+class Pubmed(datasets.ArrowBasedBuilder):
     """Pubmed citations records"""
 
     BUILDER_CONFIGS = [
@@ -193,74 +416,89 @@ class Pubmed(datasets.GeneratorBasedBuilder):
                     self.fill_keys_from_features(value)
 
     def xml_to_dictionnary(self, parentElement):
-        data = {}
-        if parentElement.tag in {"AbstractText", "ArticleTitle"}:
-            # XXX
-            # Very special case, it will contain html leading to having very odd structure
-            tag = parentElement.tag
-            string = ET.tostring(parentElement).decode("utf-8").strip()
-            inner_string = string[len(f"<{tag}>"): -len(f"</{tag}>")]
-            return {parentElement.tag: inner_string}
-
-        for child in list(parentElement):
-            child.text = child.text if (child.text is not None) else " "
-            key = child.tag
-            if len(child) == 0:
-                value = child.text.strip()
-            else:
-                value = self.xml_to_dictionnary(child)
-                if isinstance(value, dict) and set(value.keys()) == {key}:
-                    value = value[key]
-
-            if key in data:
-                old_value = data[key]
-                if isinstance(old_value, dict):
-                    data[key] = [old_value, value]
-                elif isinstance(old_value, list):
-                    data[key].append(value)
-            elif key in self.LIST_KEYS:
-                data[key] = [value]
-            elif key in self.SIMPLE_KEYS:
-                data[key] = value
-            elif key in self.IGNORE_KEYS:
-                continue
-            else:
-                logger.info(f"Ignoring key {key} from {parentElement.tag}")
-                self.IGNORE_KEYS.add(key)
-
-        # Filling defaults
-        # if parentElement.tag == "MeshHeading" and "QualifierName" not in data:
-        #     data["QualifierName"] = ""
-        # elif parentElement.tag == "Author":
-        #     if "ForeName" not in data:
-        #         data["ForeName"] = ""
-        #     if "Initials" not in data:
-        #         data["Initials"] = ""
-        #     if "LastName" not in data:
-        #         data["LastName"] = ""
-        #     if "CollectiveName" not in data:
-        #         data["CollectiveName"] = ""
-        if parentElement.tag == "JournalIssue":
-            if "Volume" not in data:
-                data["Volume"] = ""
-            if "Issue" not in data:
-                data["Issue"] = ""
-        if parentElement.tag == "PubDate":
-            if "Year" not in data:
-                if parentElement[0].tag == 'MedlineDate':
-                    _year = parentElement[0].text.split(None, maxsplit=1)[0]
-                    year_ = parentElement[0].text.rsplit(None, maxsplit=1)[-1]
-                    if _year.isdigit():
-                        data["Year"] = int(_year)
-                    elif year_.isdigit():
-                        data["Year"] = int(year_)
-                    else:
-                        data["Year"] = 0
-
-        # elif parentElement.tag == "Grant" and "GrantID" not in data:
-        #     data["GrantID"] = ""
+        # Local references to the keys sets, instead of looking up the attributes for every child element.
+        # IGNORE_KEYS is the (mutable) set itself, the ignored keys are added to it as they are found.
+        list_keys, known_keys, ignore_keys = self._list_keys, self._known_keys, self.IGNORE_KEYS
+        if parentElement.tag in INNER_XML_TAGS:
+            return {parentElement.tag: inner_xml(parentElement)}
+
+        # The elements are converted with an explicit stack of the elements that have unconverted children, instead
+        # of a recursive call per element. The dict of a child element is added to its parent when the child is
+        # reached, and it's filled when its own children are converted.
+        root_data = {}
+        stack = [(parentElement, root_data, iter(parentElement))]
+        while stack:
+            element, data, children = stack[-1]
+            for child in children:
+                key = child.tag
+                if key not in known_keys:
+                    # The elements that aren't in the features are skipped with all their children (e.g. AuthorList,
+                    # MeshHeadingList or ReferenceList), they're never converted
+                    if key not in ignore_keys:
+                        logger.info(f"Ignoring key {key} from {element.tag}")
+                        ignore_keys.add(key)
+                    continue
+                child.text = child.text if (child.text is not None) else " "
+                child_frame = None
+                if len(child) == 0:
+                    value = child.text.strip()
+                elif key in INNER_XML_TAGS:
+                    value = inner_xml(child)
+                else:
+                    value = {}
+                    child_frame = (child, value, iter(child))
+
+                if key in data:
+                    old_value = data[key]
+                    if isinstance(old_value, dict):
+                        data[key] = [old_value, value]
+                    elif isinstance(old_value, list):
+                        data[key].append(value)
+                elif key in list_keys:
+                    data[key] = [value]
+                else:
+                    data[key] = value
 
-        return {parentElement.tag: data}
+                if child_frame is not None:
+                    stack.append(child_frame)
+                    break
+            else:
+                # All the children of the element are converted
+                stack.pop()
+
+                # Filling defaults
+                # if element.tag == "MeshHeading" and "QualifierName" not in data:
+                #     data["QualifierName"] = ""
+                # elif element.tag == "Author":
+                #     if "ForeName" not in data:
+                #         data["ForeName"] = ""
+                #     if "Initials" not in data:
+                #         data["Initials"] = ""
+                #     if "LastName" not in data:
+                #         data["LastName"] = ""
+                #     if "CollectiveName" not in data:
+                #         data["CollectiveName"] = ""
+                if element.tag == "JournalIssue":
+                    if "Volume" not in data:
+                        data["Volume"] = ""
+                    if "Issue" not in data:
+                        data["Issue"] = ""
+                if element.tag == "PubDate":
+                    if "Year" not in data:
+                        if element[0].tag == 'MedlineDate':
+                            _year = element[0].text.split(None, maxsplit=1)[0]
+                            year_ = element[0].text.rsplit(None, maxsplit=1)[-1]
+                            if _year.isdigit():
+                                data["Year"] = int(_year)
+                            elif year_.isdigit():
+                                data["Year"] = int(year_)
+                            else:
+                                data["Year"] = 0
+
+                # elif element.tag == "Grant" and "GrantID" not in data:
+                #     data["GrantID"] = ""
+
+        return {parentElement.tag: root_data}
 
     def _info(self):
         Date = {
@@ -354,6 +592,9 @@ class Pubmed(datasets.GeneratorBasedBuilder):
             }
         )
         self.fill_keys_from_features(features)
+        # Snapshots of the filled keys, used while converting the XML
+        self._list_keys = frozenset(self.LIST_KEYS)
+        self._known_keys = frozenset(self.LIST_KEYS | self.SIMPLE_KEYS)
         return datasets.DatasetInfo(
             description=_DESCRIPTION,
             features=features,
@@ -364,14 +605,25 @@ class Pubmed(datasets.GeneratorBasedBuilder):
 
     def _split_generators(self, dl_manager):
         """Returns SplitGenerators."""
-        dl_dir = dl_manager.download(_URLs)
+        # The files are downloaded while generating the examples, so the download and the parsing overlap. The number of
+        # concurrent downloads is still the num_proc of the download config, and not the number of parsing processes.
+        download_config = dl_manager.download_config.copy()
+        download_config.extract_compressed_file = False
+        download_config.disable_tqdm = True
         return [
             datasets.SplitGenerator(
                 name=datasets.Split.TRAIN,
-                gen_kwargs={"filenames": dl_dir},
+                gen_kwargs={"urls": _URLs, "download_config": download_config},
             ),
         ]
 
+    def _download_and_prepare(self, dl_manager, verification_mode, **prepare_split_kwargs):
+        super()._download_and_prepare(dl_manager, verification_mode, **prepare_split_kwargs)
+        # The files were downloaded by the processes that parsed them, the download manager finds them in the cache and
+        # records their sizes and checksums (the download_checksums of the dataset info)
+        dl_manager.download(_URLs)
+        self.info.download_size = dl_manager.downloaded_size
+
     def update_citation(self, article):
         """
         ArticleId and ArticleIdList are already used field name so we rewrite and
@@ -403,37 +655,115 @@ class Pubmed(datasets.GeneratorBasedBuilder):
                         citations.append(citation)
         article["PubmedData"]["ReferenceList"] = citations
 
-    def _generate_examples(self, filenames):
-        """Yields examples."""
-        id_ = 0
-        for filename in filenames:
-            with gzip.open(filename) as f:
-                try:
-                    tree = ET.parse(f)
-                    root = tree.getroot()
-                    xmldict = self.xml_to_dictionnary(root)
-                except ET.ParseError:
-                    logger.warning(f"Ignoring file {filename}, it is malformed")
-                    continue
+    def _parse_file(self, filename, encode):
+        """Yields the articles of a single XML file, as examples encoded for the features."""
+        for article_xml in split_articles(decompress_gzip(filename)):
+            try:
+                article = self.xml_to_dictionnary(ET.fromstring(article_xml))["PubmedArticle"]
+            except ET.ParseError:
+                logger.warning(f"Ignoring an article of file {filename}, it is malformed")
+                continue
 
-                for article in xmldict["PubmedArticleSet"]["PubmedArticle"]:
-                    # self.update_citation(article)
-                    new_article = default_article()
+            # self.update_citation(article)
+            new_article = default_article()
 
-                    try:
-                        deepupdate(new_article, article)
-                    except Exception as e:
-                        logger.warning(f"Exception {e}")
-                        logger.warning(f"Ignoring article {article}, it is malformed")
-                        continue
+            try:
+                deepupdate(new_article, article)
+            except Exception as e:
+                logger.warning(f"Exception {e}")
+                logger.warning(f"Ignoring article {article}, it is malformed")
+                continue
 
-                    try:
-                        _ = self.info.features.encode_example(new_article)
-                    except Exception as e:
-                        logger.warning(f"Ignore example because {e}")
-                        continue
-                    yield id_, new_article
-                    id_ += 1
+            try:
+                example = encode(new_article)
+            except Exception as e:
+                logger.warning(f"Ignore example because {e}")
+                continue
+            yield example
+
+    def _parse_file_tables(self, filename, encode, schema):
+        """
+        Yields the articles of a single XML file as arrow tables.
+        The tables are also written to a cache file next to the XML file, and the cached tables are read on the
+        following runs (e.g. when a build is resumed) instead of parsing the file again. The name of the cache file has
+        the size and the modification time of the XML file, and a hash of the parser (a changed parser doesn't use old
+        caches). The other cache files of the XML file are outdated, they are deleted once the new one is complete.
+        """
+        stat = os.stat(filename)
+        cache_dir = ensure_dir(os.path.join(os.path.dirname(filename), "parsed"))
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(filename)}.{stat.st_size}-{stat.st_mtime_ns}-"
+                                             f"{parser_hash()}.arrow")
+        if os.path.exists(cache_path):
+            with pa.OSFile(cache_path) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield pa.Table.from_batches([reader.get_batch(i)])
+            return
+
+        # The cache is written to a temporary file that is renamed when it's complete, so a partial file is never used
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+                examples = []
+                for example in self._parse_file(filename, encode):
+                    examples.append(example)
+                    if len(examples) == TABLE_SIZE:
+                        table = pa.Table.from_pylist(examples, schema=schema)
+                        writer.write_table(table)
+                        yield table
+                        examples = []
+                if examples:
+                    table = pa.Table.from_pylist(examples, schema=schema)
+                    writer.write_table(table)
+                    yield table
+            os.replace(tmp_path, cache_path)
+            # the cache files of the XML file before it was downloaded again, or of an older parser
+            outdated_pattern = f"{glob.escape(os.path.basename(filename))}.*.arrow"
+            for outdated_path in glob.glob(os.path.join(glob.escape(cache_dir), outdated_pattern)):
+                if outdated_path != cache_path:
+                    os.remove(outdated_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _generate_tables(self, urls, download_config):
+        """Yields arrow tables of the examples."""
+        # The files are independent, with num_proc the datasets library splits the list of files between the
+        # processes, each one downloads and parses its own files with this generator.
+        # The files are downloaded (into the cache) in a background thread, while the downloaded files are parsed
+        download = partial(download_file, download_config=download_config)
+        # validate and encode the examples with an encoder compiled for the features (the same as encode_example)
+        encode = compile_encoder(self.info.features)
+        # The encoded examples are converted to arrow tables of many examples, which are written as they are, instead
+        # of passing every example to the writer of the datasets library (that encodes it again)
+        schema = self.info.features.arrow_schema
+        table_idx = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # The next file is downloaded while the current one is parsed, the downloads stay a single file ahead
+            next_download = executor.submit(download, urls[0]) if urls else None
+            for i in range(len(urls)):
+                filename = next_download.result()
+                if i + 1 < len(urls):
+                    next_download = executor.submit(download, urls[i + 1])
+                for table in self._parse_file_tables(filename, encode, schema):
+                    yield table_idx, table
+                    table_idx += 1
+
+
+@lru_cache(maxsize=None)
+def parser_hash():
+    """
+    Hash of the code that converts the XML files to examples, the parsed files that were cached by a different version
+    of the parser aren't used. The rest of the script isn't hashed, so changing it doesn't invalidate the cache.
+    """
+    sha = hashlib.sha1()
+    for function in (deep_copy, deepupdate, compile_encoder, inner_xml, escape_xml_text, serialize_children,
+                     decompress_gzip, split_articles, default_date, default_pubdate, default_inline_article,
+                     default_article, Pubmed.fill_keys_from_features, Pubmed.xml_to_dictionnary, Pubmed._info,
+                     Pubmed._parse_file):
+        sha.update(inspect.getsource(function).encode("utf-8"))
+    sha.update(repr((sorted(INNER_XML_TAGS), ARTICLE_START, ARTICLE_END, MONTHS_AND_NUMBERS)).encode("utf-8"))
+    return sha.hexdigest()[:16]
 
 
 def ensure_dir(file_path, create_if_not=True):
@@ -479,18 +809,20 @@ if __name__ == '__main__':
     # add argument parser
     parser = ArgumentParser()
     parser.add_argument("--output_dir", type=str, default="./data/pubmed/")
-    parser.add_argument("--num_proc")
+    parser.add_argument("--num_proc", type=int, default=os.cpu_count(),
+                        help="Number of processes that parse the files in parallel, defaults to the number of CPUs")
+    parser.add_argument("--download_proc", type=int, default=1,
+                        help="Maximal number of files downloaded at once, by all the processes together")
     args = parser.parse_args()
     n_proc = args.num_proc
-    if n_proc is not None:
-        n_proc = int(n_proc)
 
     output_dir = ensure_dir(args.output_dir)
     cache_dir = ensure_dir(os.path.join(output_dir.rsplit('/', 1)[0], "cache"))
 
     builder = Pubmed()
-    # set download config, using a single process as the bottleneck here is the download speed (wasn't properly tested)
-    dc = datasets.download.DownloadConfig(cache_dir=cache_dir, num_proc=1, delete_extracted=False)
+    # set download config, the files are downloaded by the processes that parse them, each one downloads its own files,
+    # but only download_proc files at once (a single one by default, the bottleneck is the download speed)
+    dc = datasets.download.DownloadConfig(cache_dir=cache_dir, num_proc=args.download_proc, delete_extracted=False)
     logger.info(f'Cache dir for raw download files {dc.cache_dir}')
     builder.download_and_prepare(output_dir=output_dir,
                                  download_config=dc,